@@ -18,10 +18,8 @@
 # along with OSD Lyrics.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-from builtins import super
-from future import standard_library
-standard_library.install_aliases()
-
+import codecs
+import functools
 import logging
 import os
 import os.path
@@ -29,7 +27,12 @@ import re
 import urllib.parse
 import urllib.request
 
-import chardet
+try:
+    # cchardet is a C binding of uchardet and much faster than chardet, while
+    # reporting the same encoding names.
+    import cchardet as chardet
+except ImportError:
+    import chardet
 import dbus
 import dbus.service
 
@@ -62,9 +65,37 @@ SUPPORTED_SCHEMES = [
     # 'tag',
     'none',
 ]
+SUPPORTED_SCHEME_PREFIXES = tuple(scheme + ':' for scheme in SUPPORTED_SCHEMES)
 
 DETECT_CHARSET_GUESS_MIN_LEN = 40
 DETECT_CHARSET_GUESS_MAX_LEN = 100
+DETECT_CHARSET_SAMPLE_LEN = 4096
+
+# The UTF-32 BOMs must be checked before the UTF-16 ones, as BOM_UTF32_LE
+# begins with BOM_UTF16_LE.
+BOM_ENCODINGS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+ENCODING_REWRITES = {
+    # When we take half of the content to determine the encoding, chardet may
+    # think it be encoded with ascii, however the full content is probably
+    # encoded with utf-8. As ascii is an subset of utf-8, decoding an ascii
+    # string with utf-8 will always be right.
+    'ascii': 'utf-8',
+    # Upgrade the Chinese encodings to their extended sets.
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+    'big5': 'big5hkscs',
+}
+
+LRC_OFFSET_PATTERN = re.compile(r'^(\[[^\]]*\])*?\[offset:(.*?)\]', re.MULTILINE)
+LRC_OFFSET_TAG = '[offset:'
+LRC_OFFSET_FAST_SEARCH_LEN = 256
 
 
 class InvalidUriException(Exception):
@@ -102,8 +133,43 @@ def decode_by_charset(content):
     '\u4e2d\u6587'
     >>> decode_by_charset(u'\u4e2d\u6587'.encode('HZ-GB-2312'))
     '\u4e2d\u6587'
+    >>> decode_by_charset(u'\ufeff\u4e2d\u6587'.encode('UTF-8'))
+    '\u4e2d\u6587'
+    >>> lrc = ''.join(u'[00:%02d.00]\u6708\u4eae\u4ee3\u8868\u6211\u7684\u5fc3\n' % (i % 60)
+    ...               for i in range(300))
+    >>> len(lrc.encode('GBK')) > 5120
+    True
+    >>> decode_by_charset(lrc.encode('GBK')) == lrc
+    True
+    >>> decode_by_charset(u'\u4e2d\u6587'.encode('UTF-16'))
+    '\u4e2d\u6587'
+    >>> decode_by_charset(u'\u4e2d\u6587'.encode('UTF-32'))
+    '\u4e2d\u6587'
     """
-    encoding = chardet.detect(content)['encoding']
+    # A BOM determines the encoding without any detection.
+    for bom, encoding in BOM_ENCODINGS:
+        if content.startswith(bom):
+            return content.decode(encoding, 'replace')
+    # Most LRC files are encoded with utf-8, so try it before the much slower
+    # charset detection. 7-bit encodings such as HZ-GB-2312 and ISO-2022 are
+    # also valid utf-8, so leave the content with their escape sequences to
+    # chardet.
+    if b'~{' not in content and b'\x1b' not in content:
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    # The cost of chardet is linear to the length of its input, while the
+    # encoding can be told from a few kilobytes. Take the head of long content
+    # as a sample, ending at a line break so that no multibyte character is
+    # cut in half.
+    sample = content
+    if len(content) > DETECT_CHARSET_SAMPLE_LEN:
+        sample_end = content.rfind(b'\n', 0, DETECT_CHARSET_SAMPLE_LEN)
+        if sample_end < 0:
+            sample_end = DETECT_CHARSET_SAMPLE_LEN
+        sample = content[:sample_end]
+    encoding = chardet.detect(sample)['encoding']
     # Sometimes, the content is well encoded but the last few bytes. This is
     # common in the files downloaded by old versions of OSD Lyrics. In this
     # case,chardet may fail to determine what the encoding it is. So we take
@@ -119,30 +185,25 @@ def decode_by_charset(content):
         encoding = 'utf-8'
 
     encoding = encoding.lower()
-    # When we take half of the content to determine the encoding, chardet may
-    # think it be encoded with ascii, however the full content is probably
-    # encoded with utf-8. As ascii is an subset of utf-8, decoding an ascii
-    # string with utf-8 will always be right.
-    if encoding == 'ascii':
-        encoding = 'utf-8'
-    # Upgrade the Chinese encodings to their extended sets.
-    elif encoding in ('gb2312', 'gbk'):
-        encoding = 'gb18030'
-    elif encoding == 'big5':
-        encoding = 'big5hkscs'
+    encoding = ENCODING_REWRITES.get(encoding, encoding)
     return content.decode(encoding, 'replace')
 
 
 def is_valid_uri(uri):
+    # type: (Text) -> bool
     """
     Tell if a URI is valid.
 
     A valid URI must begin with the schemes defined in SUPPORTED_SCHEMES
+
+    >>> is_valid_uri('file:///path/to/file.lrc')
+    True
+    >>> is_valid_uri('none:')
+    True
+    >>> is_valid_uri('http://example.com/file.lrc')
+    False
     """
-    for scheme in SUPPORTED_SCHEMES:
-        if uri.startswith(scheme + ':'):
-            return True
-    return False
+    return uri.startswith(SUPPORTED_SCHEME_PREFIXES)
 
 
 def ensure_uri_scheme(uri):
@@ -152,25 +213,72 @@ def ensure_uri_scheme(uri):
     changed
 
     If the uri doesn't have any scheme, it is considered to be a file path.
+
+    >>> ensure_uri_scheme('/path/to/file.lrc')
+    'file:///path/to/file.lrc'
+    >>> ensure_uri_scheme('file:///path/to/file.lrc')
+    'file:///path/to/file.lrc'
+    >>> ensure_uri_scheme('http://example.com/file.lrc')
+    'http://example.com/file.lrc'
     """
-    if uri:
+    if uri and not uri.startswith(SUPPORTED_SCHEME_PREFIXES):
         url_parts = urllib.parse.urlparse(uri)
         if not url_parts.scheme:
             uri = osdlyrics.utils.path2uri(uri)
     return uri
 
 
-def _load_from_file(urlparts):
+@functools.lru_cache(maxsize=64)
+def _read_lrc_file(path, mtime_ns, size):
+    # type: (Text, int, int) -> Text
+    """
+    Read and decode the LRC file at `path`.
+
+    `mtime_ns` and `size` are only used as part of the cache key, so that a
+    file changed on disk is read again. Raises IOError if the file cannot be
+    read.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    content = decode_by_charset(content)
+    # Searching is much cheaper than replace(), and NUL characters are rare.
+    if '\0' in content:
+        content = content.replace('\0', '')
+    return content
+
+
+def _file_uri_to_path(uri):
+    # type: (Text) -> Optional[Text]
+    r"""
+    Return the local path of a plain file URI without parsing the whole URI.
+
+    Return None if `uri` is not a file URI with an empty host, a query or a
+    fragment, in which case urlparse should be used instead.
+
+    >>> _file_uri_to_path('file:///path/to/file.lrc')
+    '/path/to/file.lrc'
+    >>> _file_uri_to_path('file:///%E6%AD%8C%E8%AF%8D.lrc')
+    '/\u6b4c\u8bcd.lrc'
+    >>> _file_uri_to_path('file://host/path/to/file.lrc') is None
+    True
+    >>> _file_uri_to_path('none:') is None
+    True
+    """
+    if uri.startswith('file:///') and '?' not in uri and '#' not in uri:
+        return urllib.parse.unquote(uri[len('file://'):])
+    return None
+
+
+def _load_from_file(path):
     """
-    Load the content of file from urlparse.ParseResult
+    Load the content of file from a local path
 
-    Return the content of the file, or None if error raised.
+    Return the decoded content of the file, or None if error raised.
     """
-    path = urllib.request.url2pathname(urlparts.path)
     try:
-        with open(path, 'rb') as f:
-            return f.read()
-    except IOError as e:
+        st = os.stat(path)
+        return _read_lrc_file(path, st.st_mtime_ns, st.st_size)
+    except (IOError, OSError) as e:
         logging.info("Cannot open file %s to read: %s", path, e)
         return None
 
@@ -182,27 +290,29 @@ def load_from_uri(uri):
 
     If loaded, return the content. If failed, return None.
     """
+    if uri.startswith('none:'):
+        return ''
+    path = _file_uri_to_path(uri)
+    if path is not None:
+        return _load_from_file(path)
+
     URI_LOAD_HANDLERS = {
         'file': _load_from_file,
-        'none': lambda uri: b'',
+        'none': lambda path: '',
     }
 
     url_parts = urllib.parse.urlparse(uri)
-    content = URI_LOAD_HANDLERS[url_parts.scheme](url_parts)
-    if content is None:
-        return None
-    content = decode_by_charset(content).replace('\0', '')
-    return content
+    path = urllib.request.url2pathname(url_parts.path)
+    return URI_LOAD_HANDLERS[url_parts.scheme](path)
 
 
-def _save_to_file(urlparts, content, create):
-    # type: (Any, bytes, bool) -> bool
+def _save_to_file(path, content, create):
+    # type: (Text, bytes, bool) -> bool
     """
-    Save the content of file to urlparse.ParseResult
+    Save the content of file to a local path
 
     Return True if succeeded
     """
-    path = urllib.request.url2pathname(urlparts.path)
     if not create:
         if not os.path.isfile(path):
             logging.warning("Cannot write to file %s: file not exists", path)
@@ -216,11 +326,14 @@ def _save_to_file(urlparts, content, create):
                 logging.warning("Cannot create directories for %s: %s", path, e)
                 return False
     try:
-        file = open(path, 'wb')
+        with open(path, 'wb') as f:
+            f.write(content)
     except IOError as e:
-        logging.info("Cannot open file %s to write: %s", path, e)
+        logging.info("Cannot write to file %s: %s", path, e)
         return False
-    file.write(content)
+    # The file may be rewritten within the timestamp granularity of the file
+    # system, so don't rely on the cache key to notice the change.
+    _read_lrc_file.cache_clear()
     return True
 
 
@@ -231,20 +344,30 @@ def save_to_uri(uri, content, create=True):
 
     Return True if succeeded, or False if failed.
     """
+    if uri.startswith('none:'):
+        return True
+    path = _file_uri_to_path(uri)
+    if path is not None:
+        return _save_to_file(path, content, create)
+
     URI_SAVE_HANDLERS = {
         'file': _save_to_file,
-        'none': lambda urlparts, content, create: True,
+        'none': lambda path, content, create: True,
     }
 
     url_parts = urllib.parse.urlparse(uri)
-    return URI_SAVE_HANDLERS[url_parts.scheme](url_parts, content, create)
+    path = urllib.request.url2pathname(url_parts.path)
+    return URI_SAVE_HANDLERS[url_parts.scheme](path, content, create)
 
 
 def update_lrc_offset(content, offset):
+    # type: (Text, int) -> Text
     r"""
     Replace the offset attributes in the content of LRC file.
     >>> update_lrc_offset('no tag', 100)
     '[offset:100]\nno tag'
+    >>> update_lrc_offset('[offset:200]\nSome lrc', 100)
+    '[offset:100]\nSome lrc'
     >>> update_lrc_offset('[ti:title]\n[offset:200]\nSome lrc', 100)
     '[ti:title]\n[offset:100]\nSome lrc'
     >>> update_lrc_offset('[ti:title][offset:200]Some lrc\nanother', 100)
@@ -254,9 +377,18 @@ def update_lrc_offset(content, offset):
     >>> update_lrc_offset('[[offset:200]] lrc', 100)
     '[offset:100]\n[[offset:200]] lrc'
     """
-    search_result = re.search(r'^(\[[^\]]*\])*?\[offset:(.*?)\]',
-                              content,
-                              re.MULTILINE)
+    # The offset tag is usually in its own line near the beginning of the
+    # file, which can be found without the regular expression. A "[" not
+    # closed before the tag may start a tag spanning lines, so leave that case
+    # to the pattern.
+    index = content.find(LRC_OFFSET_TAG, 0, LRC_OFFSET_FAST_SEARCH_LEN)
+    if index >= 0 and (index == 0 or content[index - 1] == '\n') and \
+            content.rfind('[', 0, index) <= content.rfind(']', 0, index):
+        start = index + len(LRC_OFFSET_TAG)
+        end = content.find(']', start)
+        if end >= 0 and content.find('\n', start, end) < 0:
+            return '%s%s%s' % (content[:start], offset, content[end:])
+    search_result = LRC_OFFSET_PATTERN.search(content)
     if search_result is None:
         return '[offset:%s]\n%s' % (offset, content)
     return '%s%s%s' % (content[:search_result.start(2)],
@@ -264,6 +396,28 @@ def update_lrc_offset(content, offset):
                        content[search_result.end(2):])
 
 
+def _expand_unique(patterns, expand_func, metadata):
+    """
+    Expand each of the patterns with `expand_func`, skipping the patterns that
+    cannot be expanded and the duplicated results.
+
+    >>> _expand_unique(['%t', '%p', '%t-%p', 'Title'], expand_file,
+    ...                Metadata(title='Title', artist='Artist'))
+    ['Title', 'Artist', 'Title-Artist']
+    >>> _expand_unique(['%', '/path'], expand_path, Metadata())
+    ['/path']
+    """
+    ret = []
+    for pattern in patterns:
+        try:
+            value = expand_func(pattern, metadata)
+        except osdlyrics.pattern.PatternException:
+            continue
+        if value not in ret:
+            ret.append(value)
+    return ret
+
+
 class LyricsService(dbus.service.Object):
 
     def __init__(self, conn):
@@ -271,6 +425,12 @@ class LyricsService(dbus.service.Object):
         self._db = lrcdb.LrcDb()
         self._config = osdlyrics.config.Config(conn)
         self._metadata = Metadata()
+        self._file_patterns = None
+        self._path_patterns = None
+        self._config.connect_change('General/lrc-filename',
+                                    self._patterns_changed_cb)
+        self._config.connect_change('General/lrc-path',
+                                    self._patterns_changed_cb)
 
     def find_lrc_from_db(self, metadata):
         uri = self._db.find(metadata)
@@ -374,6 +534,38 @@ class LyricsService(dbus.service.Object):
         if not save_to_uri(uri, content, True):
             raise CannotSaveLrcException(uri)
 
+    def _get_patterns(self):
+        """ Return a tuple of the file patterns and the path patterns
+
+        The patterns are cached until they are changed in the config.
+        """
+        if self._file_patterns is None:
+            self._file_patterns = self._config.get_string_list('General/lrc-filename',
+                                                               DEFAULT_FILE_PATTERNS)
+        if self._path_patterns is None:
+            self._path_patterns = self._config.get_string_list('General/lrc-path',
+                                                               DEFAULT_PATH_PATTERNS)
+        return self._file_patterns, self._path_patterns
+
+    def _patterns_changed_cb(self, name):
+        if name == 'General/lrc-filename':
+            self._file_patterns = None
+        elif name == 'General/lrc-path':
+            self._path_patterns = None
+
+    def _expand_lrc_names(self, metadata):
+        """ Return the lists of directories and LRC file names expanded from
+        the patterns
+
+        Patterns that cannot be expanded are skipped, and duplicated results
+        are removed.
+        """
+        file_patterns, path_patterns = self._get_patterns()
+        paths = _expand_unique(path_patterns, expand_path, metadata)
+        filenames = [filename + '.lrc'
+                     for filename in _expand_unique(file_patterns, expand_file, metadata)]
+        return paths, filenames
+
     def _save_to_patterns(self, metadata, content):
         """ Save content to file expanded from given patterns
 
@@ -381,42 +573,20 @@ class LyricsService(dbus.service.Object):
         - `metadata`:
         - `content`:
         """
-        file_patterns = self._config.get_string_list('General/lrc-filename',
-                                                     DEFAULT_FILE_PATTERNS)
-        path_patterns = self._config.get_string_list('General/lrc-path',
-                                                     DEFAULT_PATH_PATTERNS)
-        for path_pat in path_patterns:
-            try:
-                path = expand_path(path_pat, metadata)
-            except osdlyrics.pattern.PatternException:
-                continue
-            for file_pat in file_patterns:
-                try:
-                    filename = expand_file(file_pat, metadata)
-                except osdlyrics.pattern.PatternException:
-                    continue
-                fullpath = os.path.join(path, filename + '.lrc')
+        paths, filenames = self._expand_lrc_names(metadata)
+        for path in paths:
+            for filename in filenames:
+                fullpath = os.path.join(path, filename)
                 uri = osdlyrics.utils.path2uri(fullpath)
                 if save_to_uri(uri, content):
                     return uri
         return ''
 
     def _expand_patterns(self, metadata):
-        file_patterns = self._config.get_string_list('General/lrc-filename',
-                                                     DEFAULT_FILE_PATTERNS)
-        path_patterns = self._config.get_string_list('General/lrc-path',
-                                                     DEFAULT_PATH_PATTERNS)
-        for path_pat in path_patterns:
-            try:
-                path = expand_path(path_pat, metadata)
-            except osdlyrics.pattern.PatternException:
-                continue
-            for file_pat in file_patterns:
-                try:
-                    filename = expand_file(file_pat, metadata)
-                except osdlyrics.pattern.PatternException:
-                    continue
-                fullpath = os.path.join(path, filename + '.lrc')
+        paths, filenames = self._expand_lrc_names(metadata)
+        for path in paths:
+            for filename in filenames:
+                fullpath = os.path.join(path, filename)
                 if os.path.isfile(fullpath):
                     return fullpath
         return None
@@ -25,8 +25,6 @@ import re
 
 import dbus
 
-from .consts import METADATA_ALBUM, METADATA_ARTIST, METADATA_TITLE
-
 
 class Metadata(object):
     """
@@ -104,10 +102,8 @@ class Metadata(object):
             return True
         if self.location == other.location and self.location != '':
             return True
-        for key in [METADATA_TITLE, METADATA_ARTIST, METADATA_ALBUM]:
-            if getattr(self, key) != getattr(other, key):
-                return False
-        return True
+        return (self.title, self.artist, self.album) == \
+            (other.title, other.artist, other.album)
 
     def to_mpris1(self):
         """
@@ -22,6 +22,7 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 
+import functools
 import os.path
 import urllib.parse
 import urllib.request
@@ -74,6 +75,51 @@ def expand_file(pattern, metadata):
         ...
     osdlyrics.errors.PatternException: title not in metadata
     """
+    return _compile_file_pattern(pattern)(metadata)
+
+
+def _expand_location_name(metadata):
+    """
+    Return the file name without extension of the music, used by %f
+    """
+    location = metadata.location
+    if not location:
+        raise PatternException('Location not found in metadata')
+    uri = urllib.parse.urlparse(location)
+    if uri.scheme == '':
+        path = uri.path
+    elif uri.scheme == 'file':
+        path = urllib.request.url2pathname(uri.path)
+    else:
+        raise PatternException('Unsupported file scheme %s' % uri.scheme)
+    basename = os.path.basename(path)
+    root, ext = os.path.splitext(basename)
+    return root
+
+
+def _metadata_getter(key):
+    """
+    Return a function that gets the value of attribute `key` from metadata for
+    placeholders such as %t
+    """
+    def getter(metadata):
+        value = getattr(metadata, key)
+        if not value:
+            raise PatternException('%s not in metadata' % key)
+        if not isinstance(value, str):
+            value = str(value)
+        return value.replace('/', '_')
+    return getter
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_file_pattern(pattern):
+    """
+    Parse a file name pattern into a function that expands it with metadata.
+
+    Patterns rarely change, so the parsed result is cached and only the
+    metadata lookups are done on each expansion.
+    """
     keys = {'t': 'title',
             'p': 'artist',
             'a': 'album',
@@ -81,48 +127,46 @@ def expand_file(pattern, metadata):
             }
     start = 0
     parts = []
+    literal = []
     while start < len(pattern):
         end = pattern.find('%', start)
         if end > -1:
-            parts.append(pattern[start:end])
-            has_tag = False
+            literal.append(pattern[start:end])
+            getter = None
             if end + 1 < len(pattern):
                 tag = pattern[end + 1]
                 if tag == '%':
-                    has_tag = True
-                    parts.append('%')
+                    literal.append('%')
+                    start = end + 2
+                    continue
                 elif tag == 'f':
-                    location = metadata.location
-                    if not location:
-                        raise PatternException('Location not found in metadata')
-                    uri = urllib.parse.urlparse(location)
-                    if uri.scheme == '':
-                        path = uri.path
-                    elif uri.scheme == 'file':
-                        path = urllib.request.url2pathname(uri.path)
-                    else:
-                        raise PatternException('Unsupported file scheme %s' % uri.scheme)
-                    basename = os.path.basename(path)
-                    root, ext = os.path.splitext(basename)
-                    has_tag = True
-                    parts.append(root)
+                    getter = _expand_location_name
                 elif tag in keys:
-                    value = getattr(metadata, keys[tag])
-                    if not value:
-                        raise PatternException('%s not in metadata' % keys[tag])
-                    if not isinstance(value, str):
-                        value = str(value)
-                    has_tag = True
-                    parts.append(value.replace('/', '_'))
-            if has_tag:
+                    getter = _metadata_getter(keys[tag])
+            if getter is not None:
+                parts.append(''.join(literal))
+                parts.append(getter)
+                literal = []
                 start = end + 2
             else:
                 start = end + 1
-                parts.append('%')
+                literal.append('%')
         else:
-            parts.append(pattern[start:])
+            literal.append(pattern[start:])
             break
-    return ''.join(parts)
+    parts.append(''.join(literal))
+
+    # Literals are at even indices and getters at odd ones.
+    literals = parts[::2]
+    getters = parts[1::2]
+
+    def expand(metadata):
+        values = [literals[0]]
+        for getter, literal in zip(getters, literals[1:]):
+            values.append(getter(metadata))
+            values.append(literal)
+        return ''.join(values)
+    return expand
 
 
 def expand_path(pattern, metadata):
@@ -155,19 +199,41 @@ def expand_path(pattern, metadata):
         ...
     osdlyrics.errors.PatternException: Location not found in metadata
     """
+    return _compile_path_pattern(pattern)(metadata)
+
+
+def _expand_location_dir(metadata):
+    """
+    Return the directory of the music file, used by the `%' path pattern
+    """
+    location = metadata.location
+    if not location:
+        raise PatternException('Location not found in metadata')
+    uri = urllib.parse.urlparse(location)
+    if uri.scheme != 'file':
+        raise PatternException('Unsupported scheme: %s' % uri.scheme)
+    path = urllib.request.url2pathname(uri.path)
+    return os.path.dirname(path)
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_path_pattern(pattern):
+    """
+    Parse a path pattern into a function that expands it with metadata.
+
+    Only the `%' pattern depends on metadata, other patterns are expanded once
+    and cached.
+    """
     if pattern == '%':
-        location = metadata.location
-        if not location:
-            raise PatternException('Location not found in metadata')
-        uri = urllib.parse.urlparse(location)
-        if uri.scheme != 'file':
-            raise PatternException('Unsupported scheme: %s' % uri.scheme)
-        path = urllib.request.url2pathname(uri.path)
-        return os.path.dirname(path)
+        return _expand_location_dir
     path = os.path.expanduser(pattern)
     if not os.path.isabs(path):
-        raise PatternException('Path is not absolute: %s' % path)
-    return path
+        def expand(metadata):
+            raise PatternException('Path is not absolute: %s' % path)
+    else:
+        def expand(metadata):
+            return path
+    return expand
 
 
 if __name__ == '__main__':
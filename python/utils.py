@@ -18,15 +18,13 @@
 # along with OSD Lyrics.  If not, see <https://www.gnu.org/licenses/>.
 #
 from __future__ import unicode_literals
-from future import standard_library
-standard_library.install_aliases()
-from builtins import object, str
 
+import functools
 import io
 import os
 import os.path
 import stat
-import sys
+import threading
 import urllib.parse
 import urllib.request
 
@@ -37,16 +35,20 @@ __all__ = (
     'ensure_path',
     'get_config_path',
     'http_download',
+    'http_download_many',
     'path2uri',
 )
 
 pycurl.global_init(pycurl.GLOBAL_DEFAULT)
 
-if sys.version_info < (3, 0):
-    # make sure the default encoding is utf-8
-    if sys.getdefaultencoding() != 'utf-8':
-        reload(sys)
-        sys.setdefaultencoding('utf-8')
+# Share DNS cache and TLS sessions among all curl handles, so that repeated
+# requests to the same host don't resolve and handshake from scratch.
+_curl_share = pycurl.CurlShare()
+_curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+_curl_share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+# Curl handles reused by http_download, one for each thread.
+_curl_pool = threading.local()
 
 
 class ProxySettings(object):
@@ -83,6 +85,7 @@ def get_config_path(filename='', expanduser=True):
     return path
 
 
+@functools.lru_cache(maxsize=256)
 def path2uri(path):
     # type: (Text) -> Text
     r"""
@@ -183,19 +186,28 @@ def get_envar_proxy():
     return ProxySettings(protocol='no')
 
 
+DESKTOP_SESSION_PREFIXES = (
+    ('gnome', 'gnome'),
+    ('kde', 'kde'),
+    ('ubuntu', 'unity'),
+    ('unity', 'unity'),
+)
+
+
+@functools.lru_cache(maxsize=1)
 def detect_desktop_shell():
     r"""
     Detect the currently running destop shell.
 
+    The desktop shell doesn't change during the process, so the result is
+    cached.
+
     Returns: 'gnome', 'unity', 'kde', or 'unknown'
     """
-    envar = os.environ.get('DESKTOP_SESSION')
-    if envar.startswith('gnome'):
-        return 'gnome'
-    if envar.startswith('kde'):
-        return 'kde'
-    if envar.startswith('ubuntu') or envar.startswith('unity'):
-        return 'unity'
+    envar = (os.environ.get('DESKTOP_SESSION') or '').lower()
+    for prefix, name in DESKTOP_SESSION_PREFIXES:
+        if envar.startswith(prefix):
+            return name
     return 'unknown'
 
 
@@ -300,10 +312,93 @@ def http_download(url, port=0, method='GET', params={}, headers={}, timeout=15,
     >>> b'Python' in content
     True
     """
+    # Reusing the handle of the thread keeps the connections to the hosts
+    # alive between requests.
+    c = getattr(_curl_pool, 'curl', None)
+    if c is None:
+        c = _curl_pool.curl = _new_curl()
+    try:
+        buf = _setup_curl(c, url, port, method, params, headers, proxy)
+        c.perform()
+        return c.getinfo(pycurl.HTTP_CODE), buf.getvalue()
+    finally:
+        c.reset()
+
+
+def http_download_many(requests):
+    # type: (List[Dict[Text, Any]]) -> List[Tuple[int, bytes]]
+    r"""
+    Download several urls concurrently.
+
+    Arguments:
+     - `requests`: A list of dicts. Each dict holds the keyword arguments of one
+                   `http_download` call.
+
+    Returns a list of `(code, content)` tuples in the same order as `requests`.
+    If any of the transfers fails, a `pycurl.error` is raised after all of them
+    are finished, as `http_download` would do.
+
+    >>> results = http_download_many([{'url': 'http://www.python.org/'},
+    ...                               {'url': 'http://www.python.org/about/'}])
+    >>> [code for code, content in results]
+    [200, 200]
+    """
+    multi = pycurl.CurlMulti()
+    handles = []
+    try:
+        for request in requests:
+            c = _new_curl()
+            buf = _setup_curl(c,
+                              request['url'],
+                              request.get('port', 0),
+                              request.get('method', 'GET'),
+                              request.get('params', {}),
+                              request.get('headers', {}),
+                              request.get('proxy'))
+            handles.append((c, buf))
+            multi.add_handle(c)
+        num_active = len(handles)
+        while num_active:
+            ret, num_active = multi.perform()
+            if ret == pycurl.E_CALL_MULTI_PERFORM:
+                continue
+            if num_active:
+                multi.select(1.0)
+        errors = []
+        num_queued = 1
+        while num_queued:
+            num_queued, _, failed = multi.info_read()
+            errors.extend(failed)
+        if errors:
+            _, errno, errmsg = errors[0]
+            raise pycurl.error(errno, errmsg)
+        return [(c.getinfo(pycurl.HTTP_CODE), buf.getvalue()) for c, buf in handles]
+    finally:
+        for c, buf in handles:
+            multi.remove_handle(c)
+            c.close()
+        multi.close()
+
+
+def _new_curl():
+    """
+    Create a curl handle sharing DNS cache and TLS sessions with other handles.
+
+    The share is kept when the handle is reset.
+    """
     c = pycurl.Curl()
+    c.setopt(pycurl.SHARE, _curl_share)
+    return c
+
+
+def _setup_curl(c, url, port, method, params, headers, proxy):
+    """
+    Set up a handle created by `_new_curl` or reset for `http_download`.
+
+    Returns the buffer the content is written to.
+    """
     buf = io.BytesIO()
     c.setopt(pycurl.NOSIGNAL, 1)
-    c.setopt(pycurl.DNS_USE_GLOBAL_CACHE, 0)
     c.setopt(pycurl.FOLLOWLOCATION, 1)
     c.setopt(pycurl.MAXREDIRS, 5)
     c.setopt(pycurl.WRITEFUNCTION, buf.write)
@@ -340,8 +435,7 @@ def http_download(url, port=0, method='GET', params={}, headers={}, timeout=15,
     else:
         c.setopt(pycurl.PROXY, '')
 
-    c.perform()
-    return c.getinfo(pycurl.HTTP_CODE), buf.getvalue()
+    return buf
 
 
 def ensure_path(path, ignore_file_name=True):